@@ -0,0 +1,49 @@
+"""One-shot build of the knowledge base vector index used by main.py.
+
+Exports an int8 MiniLM encoder to minilm-int8/ (when optimum is installed), then writes
+kb_emb.npy (L2-normalized fp16 embeddings) and kb_texts.json next to main.py.
+Run once after changing the knowledge base:  python build_kb_index.py
+"""
+import json
+import os
+import numpy as np
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ENCODER_DIR = os.path.join(BASE_DIR, "minilm-int8")
+
+def export_quantized_encoder():
+    """Export MiniLM to ONNX and apply dynamic int8 weight quantization."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from transformers import AutoTokenizer
+
+    ORTModelForFeatureExtraction.from_pretrained(MODEL_NAME, export=True).save_pretrained(ENCODER_DIR)
+    AutoTokenizer.from_pretrained(MODEL_NAME).save_pretrained(ENCODER_DIR)
+    quantize_dynamic(
+        os.path.join(ENCODER_DIR, "model.onnx"),
+        os.path.join(ENCODER_DIR, "model_quantized.onnx"),
+        weight_type=QuantType.QInt8
+    )
+
+if __name__ == "__main__":
+    try:
+        export_quantized_encoder()
+    except ImportError as e:
+        print(f"Skipping int8 encoder export ({str(e)}): pip install optimum[onnxruntime]")
+
+    # Load after the export so the quantized encoder is picked up
+    from main import load_embeddings, knowledge_base
+    embeddings = load_embeddings()
+
+    if embeddings is None:
+        raise SystemExit("sentence-transformers is required to build the index: pip install sentence-transformers")
+
+    kb_texts = list(knowledge_base.values())
+    kb_emb = np.asarray(embeddings.embed_documents(kb_texts), dtype=np.float32)
+
+    np.save(os.path.join(BASE_DIR, "kb_emb.npy"), kb_emb.astype(np.float16))
+    with open(os.path.join(BASE_DIR, "kb_texts.json"), "w") as f:
+        json.dump(kb_texts, f)
+
+    print(f"Indexed {len(kb_texts)} articles -> kb_emb.npy {kb_emb.shape}")
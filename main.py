@@ -1,36 +1,156 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict
+from importlib.metadata import version
+from contextlib import asynccontextmanager
+from collections import defaultdict
+import asyncio
 import os
+import json
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
-import random
+from datetime import date, timedelta
+import hashlib
+import inspect
+import itertools
+import re
+import reprlib
+import time
+import numpy as np
+import orjson
+from cachetools import TTLCache
 
 # LangChain imports
 from langchain_anthropic import ChatAnthropic
-from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain_anthropic.chat_models import convert_to_anthropic_tool
 from langchain.tools import tool
-from langchain.memory import ConversationBufferMemory
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain.memory import ConversationBufferWindowMemory
+from langchain_core.messages import HumanMessage, SystemMessage, ToolMessage
 
 # Load environment variables
 load_dotenv()
 
-# Initialize FastAPI
-app = FastAPI(title="Agentic CX Assistant")
+# Session storage; idle sessions expire after 30 minutes
+sessions: Dict[str, ConversationBufferWindowMemory] = TTLCache(maxsize=10_000, ttl=1800)
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Per-session locks so concurrent requests for one session run their turns one at a time
+session_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+
+class QuantizedEncoder:
+    """int8 ONNX Runtime MiniLM encoder exposing the LangChain embed_query/embed_documents interface."""
+
+    def __init__(self, model_dir: str, num_threads: int = 0):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_padding()
+        self.tokenizer.enable_truncation(max_length=256)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, "model_quantized.onnx"),
+            options,
+            providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def embed_documents(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        # One padded forward pass per batch instead of one pass per text
+        return np.concatenate([self._encode(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)])
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+        hidden = self.session.run(None, feeds)[0]
+        # Mean-pool over real tokens, then L2-normalize
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return (pooled / np.linalg.norm(pooled, axis=1, keepdims=True)).astype(np.float32)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self._encode([text])[0]
+
+def load_embeddings(num_threads: int = 0):
+    """Load the int8 encoder exported by build_kb_index.py, else the fp32 HuggingFace model, else None.
+
+    num_threads=0 lets the runtime use every core; pass 1 when running several workers.
+    """
+    try:
+        return QuantizedEncoder(os.path.join(base_dir, "minilm-int8"), num_threads)
+    except Exception as e:
+        print(f"Quantized encoder unavailable: {str(e)}")
+    try:
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        if num_threads:
+            import torch
+            torch.set_num_threads(num_threads)
+        return HuggingFaceEmbeddings(
+            model_name="sentence-transformers/all-MiniLM-L6-v2",
+            encode_kwargs={"normalize_embeddings": True, "batch_size": 32}
+        )
+    except Exception as e:
+        print(f"Embeddings disabled: {str(e)}")
+        return None
+
+class SemanticCache:
+    """Per-session cache of chat responses keyed by L2-normalized message embeddings."""
+
+    def __init__(self, threshold: float = 0.92, ttl: float = 300, max_entries: int = 50):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: Dict[str, dict] = TTLCache(maxsize=1000, ttl=3600)
+
+    def get(self, session_id: str, embedding: np.ndarray) -> Optional[dict]:
+        entry = self.entries.get(session_id)
+        if entry is None or not entry["responses"]:
+            return None
+        now = time.time()
+        # Cosine similarity is a single matrix-vector product on normalized vectors
+        sims = entry["matrix"] @ embedding
+        sims[entry["expires"] <= now] = -1.0
+        best = int(sims.argmax())
+        if sims[best] < self.threshold:
+            return None
+        entry["last_used"][best] = now
+        return entry["responses"][best]
+
+    def put(self, session_id: str, embedding: np.ndarray, response: dict):
+        now = time.time()
+        entry = self.entries.get(session_id)
+        if entry is None:
+            entry = {
+                "matrix": np.empty((0, embedding.shape[0]), dtype=np.float32),
+                "responses": [],
+                "expires": np.empty(0),
+                "last_used": np.empty(0),
+            }
+        # Drop expired entries, then least recently used ones to make room
+        keep = np.flatnonzero(entry["expires"] > now)
+        if len(keep) >= self.max_entries:
+            keep = np.sort(keep[np.argsort(entry["last_used"][keep])][len(keep) - self.max_entries + 1:])
+        entry["matrix"] = np.vstack([entry["matrix"][keep], embedding[None, :]])
+        entry["responses"] = [entry["responses"][i] for i in keep] + [response]
+        entry["expires"] = np.append(entry["expires"][keep], now + self.ttl)
+        entry["last_used"] = np.append(entry["last_used"][keep], now)
+        self.entries[session_id] = entry
+
+    def clear(self, session_id: str):
+        self.entries.pop(session_id, None)
+
+response_cache = SemanticCache()
 
-# Session storage
-sessions: Dict[str, ConversationBufferMemory] = {}
+# Only answers drawn purely from these tools are cached: order lookups and refunds depend on
+# arguments the message embedding does not capture, and tool-less answers may rely on history
+cacheable_tools = {"search_knowledge_base"}
 
 # Simple knowledge base (lightweight, no vector DB)
 knowledge_base = {
@@ -46,45 +166,94 @@ knowledge_base = {
     "security": "Account Security: We recommend using strong passwords (min 12 characters) and enabling two-factor authentication. Never share your password. We'll never ask for your password via email or phone."
 }
 
-# Helper function to generate recent date
-def get_random_recent_date():
-    """Generate a random date within the last 7 days"""
-    days_ago = random.randint(1, 7)
-    date = datetime.now() - timedelta(days=days_ago)
-    return date.strftime("%Y-%m-%d")
+# Knowledge base keys in match priority order
+key_rank = {key: rank for rank, key in enumerate(knowledge_base)}
+
+# Common synonyms and variations, only consulted when no knowledge base key appears in the query
+synonym_to_key = {
+    "money back": "refund", "return money": "refund",
+    "ship": "shipping", "delivery": "shipping", "deliver": "shipping",
+    "send back": "return",
+    "guarantee": "warranty", "coverage": "warranty",
+    "pay": "payment", "credit card": "payment", "paypal": "payment",
+    "track": "tracking", "where is my order": "tracking", "order status": "tracking",
+    "cancellation": "cancel",
+    "overseas": "international", "abroad": "international",
+    "help": "support", "contact": "support", "hours": "support",
+    "password": "security", "account safety": "security", "2fa": "security",
+}
+
+# Precompiled matchers; longest keywords first so overlapping phrases prefer the more specific one
+key_pattern = re.compile("|".join(map(re.escape, sorted(knowledge_base, key=len, reverse=True))))
+synonym_pattern = re.compile("|".join(map(re.escape, sorted(synonym_to_key, key=len, reverse=True))))
+
+def match_topic(query_lower: str) -> Optional[str]:
+    """Knowledge base key for a query: direct keys beat synonyms, ties go to the higher-priority key."""
+    keys = [match.group(0) for match in key_pattern.finditer(query_lower)]
+    if not keys:
+        keys = [synonym_to_key[match.group(0)] for match in synonym_pattern.finditer(query_lower)]
+    return min(keys, key=key_rank.__getitem__) if keys else None
+
+def load_kb_index():
+    """Load the article embeddings built by build_kb_index.py, or (None, []) to fall back to keyword matching."""
+    try:
+        # Stored as fp16 on disk; upcast once so each query is a single fp32 matrix-vector product
+        kb_emb = np.load(os.path.join(base_dir, "kb_emb.npy")).astype(np.float32)
+        with open(os.path.join(base_dir, "kb_texts.json")) as f:
+            return kb_emb, json.load(f)
+    except Exception as e:
+        print(f"Vector search disabled, using keyword matching: {str(e)}")
+        return None, []
+
+# Mock order dates, precomputed once per day and rotated across lookups
+def build_date_rings(today: date):
+    recent = tuple((today - timedelta(days=d)).strftime("%Y-%m-%d") for d in range(1, 8))
+    future = tuple((today + timedelta(days=d)).strftime("%Y-%m-%d") for d in range(2, 6))
+    return today, recent, future
+
+dates_built_on, recent_dates, future_dates = build_date_rings(date.today())
+date_counter = itertools.count()
+
+# Mock order database (dates are filled in per lookup)
+orders = {
+    "12345": {
+        "order_id": "12345",
+        "items": ["Laptop", "Wireless Mouse"],
+        "total": "$1,299.99",
+        "status": "Delivered",
+        "tracking": "TRACK123"
+    },
+    "67890": {
+        "order_id": "67890",
+        "items": ["Headphones"],
+        "total": "$299.99",
+        "status": "In Transit",
+        "tracking": "TRACK456"
+    }
+}
 
 # Define Tools
 @tool
 def lookup_order(order_id: str) -> dict:
     """Look up order details by order ID. Returns order information including items, status, and tracking."""
-    # Generate dynamic recent date
-    recent_date = get_random_recent_date()
+    global dates_built_on, recent_dates, future_dates
+    order = orders.get(order_id)
+    if not order:
+        return {"error": f"Order {order_id} not found"}
     
-    # Mock database with dynamic dates
-    orders = {
-        "12345": {
-            "order_id": "12345",
-            "items": ["Laptop", "Wireless Mouse"],
-            "total": "$1,299.99",
-            "status": "Delivered",
-            "delivery_date": recent_date,
-            "tracking": "TRACK123"
-        },
-        "67890": {
-            "order_id": "67890",
-            "items": ["Headphones"],
-            "total": "$299.99",
-            "status": "In Transit",
-            "estimated_delivery": (datetime.now() + timedelta(days=random.randint(2, 5))).strftime("%Y-%m-%d"),
-            "tracking": "TRACK456"
-        }
-    }
+    # Rebuild the rings when the day changes so dates stay relative to today
+    today = date.today()
+    if today != dates_built_on:
+        dates_built_on, recent_dates, future_dates = build_date_rings(today)
     
-    order = orders.get(order_id)
-    if order:
-        return order
+    # Copy so callers never mutate the shared mock record
+    order = dict(order)
+    n = next(date_counter)
+    if order["status"] == "Delivered":
+        order["delivery_date"] = recent_dates[n % len(recent_dates)]
     else:
-        return {"error": f"Order {order_id} not found"}
+        order["estimated_delivery"] = future_dates[n % len(future_dates)]
+    return order
 
 @tool
 def process_refund(order_id: str, reason: str) -> dict:
@@ -108,43 +277,36 @@ def process_refund(order_id: str, reason: str) -> dict:
 @tool
 def search_knowledge_base(query: str) -> str:
     """Search company knowledge base for policies and information."""
-    query_lower = query.lower()
+    # Vector search when the article embeddings and embedding model are available
+    state = app.state
+    if state.kb_emb is not None and state.embeddings is not None:
+        query_embedding = np.asarray(state.embeddings.embed_query(query), dtype=np.float32)
+        # Cosine similarity against every article, then the top 2 without a full sort
+        scores = state.kb_emb @ query_embedding
+        top = np.argpartition(-scores, 1)[:2] if len(scores) > 2 else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        # A confident top hit answers on its own; weak matches fall through to keyword matching
+        if scores[top[0]] > 0.8:
+            return state.kb_texts[top[0]]
+        hits = [state.kb_texts[i] for i in top if scores[i] >= 0.3]
+        if len(hits) == 1:
+            return hits[0]
+        if hits:
+            return "\n\n".join(hits)
     
-    # Direct keyword matching
-    for key, value in knowledge_base.items():
-        if key in query_lower:
-            return value
-    
-    # Common synonyms and variations
-    if any(word in query_lower for word in ["refund", "money back", "return money"]):
-        return knowledge_base["refund"]
-    if any(word in query_lower for word in ["ship", "delivery", "deliver", "shipping"]):
-        return knowledge_base["shipping"]
-    if any(word in query_lower for word in ["return", "send back"]):
-        return knowledge_base["return"]
-    if any(word in query_lower for word in ["warranty", "guarantee", "coverage"]):
-        return knowledge_base["warranty"]
-    if any(word in query_lower for word in ["pay", "payment", "credit card", "paypal"]):
-        return knowledge_base["payment"]
-    if any(word in query_lower for word in ["track", "tracking", "where is my order", "order status"]):
-        return knowledge_base["tracking"]
-    if any(word in query_lower for word in ["cancel", "cancellation"]):
-        return knowledge_base["cancel"]
-    if any(word in query_lower for word in ["international", "overseas", "abroad"]):
-        return knowledge_base["international"]
-    if any(word in query_lower for word in ["support", "help", "contact", "hours"]):
-        return knowledge_base["support"]
-    if any(word in query_lower for word in ["security", "password", "account safety", "2fa"]):
-        return knowledge_base["security"]
+    # Keyword matching
+    topic = match_topic(query.lower())
+    if topic:
+        return knowledge_base[topic]
     
     return "I don't have specific information about that in our knowledge base. Please contact our support team at support@example.com or call 1-800-SUPPORT for assistance."
 
 # Initialize LangChain Agent
 tools = [lookup_order, process_refund, search_knowledge_base]
+tools_by_name = {t.name: t for t in tools}
 
-# Create prompt template
-prompt = ChatPromptTemplate.from_messages([
-    ("system", """You are a helpful customer service agent. You have access to tools to:
+# System prompt
+system_prompt = """You are a helpful customer service agent. You have access to tools to:
 1. Look up order information
 2. Process refunds
 3. Search the knowledge base for policies
@@ -153,21 +315,223 @@ When a customer asks about an order, use the lookup_order tool.
 When a customer wants a refund, first look up the order, then process the refund.
 When a customer asks about policies, use the search_knowledge_base tool.
 
-Be friendly, helpful, and professional. Always explain what you're doing."""),
-    MessagesPlaceholder(variable_name="chat_history"),
-    ("human", "{input}"),
-    MessagesPlaceholder(variable_name="agent_scratchpad"),
+Be friendly, helpful, and professional. Always explain what you're doing."""
+
+# The prompt never changes, so mark it for Anthropic prompt caching (covers the tool definitions too)
+system_message = SystemMessage(content=[
+    {"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}
 ])
 
-# Initialize LLM
-llm = ChatAnthropic(
-    model="claude-sonnet-4-5-20250929",
-    temperature=0,
-    api_key=os.getenv("ANTHROPIC_API_KEY")
+def load_tool_schemas() -> List[dict]:
+    """Anthropic tool schemas, cached on disk keyed by the tool source and package versions.
+
+    Converting the @tool functions runs pydantic schema introspection; with several
+    workers the first one writes the cache and the rest just read it.
+    """
+    # Schema generation spans langchain-core, pydantic and the Anthropic converter
+    source = "".join(inspect.getsource(t.func) for t in tools) + "".join(
+        version(package) for package in ("langchain-anthropic", "langchain-core", "pydantic")
+    )
+    key = hashlib.sha256(source.encode()).hexdigest()
+    cache_dir = os.path.join(base_dir, ".tool_cache")
+    path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    
+    schemas = [convert_to_anthropic_tool(t) for t in tools]
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write then rename so concurrent workers never read a partial file
+        tmp_path = f"{path}.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(schemas, f)
+        os.replace(tmp_path, path)
+        # Prune schemas left behind by older tool code or package versions
+        for name in os.listdir(cache_dir):
+            if name.endswith(".json") and name != f"{key}.json":
+                os.remove(os.path.join(cache_dir, name))
+    except OSError as e:
+        print(f"Tool schema cache disabled: {str(e)}")
+    return schemas
+
+max_iterations = 5
+
+class StepRepr(reprlib.Repr):
+    """reprlib.Repr that keeps dict insertion order (the stock one sorts keys)."""
+
+    def repr_dict(self, x, level):
+        if not x:
+            return "{}"
+        if level <= 0:
+            return "{" + self.fillvalue + "}"
+        pieces = [
+            f"{self.repr1(key, level - 1)}: {self.repr1(value, level - 1)}"
+            for key, value in itertools.islice(x.items(), self.maxdict)
+        ]
+        if len(x) > self.maxdict:
+            pieces.append(self.fillvalue)
+        return "{" + ", ".join(pieces) + "}"
+
+# Bounded repr for agent step traces, so long tool outputs are cut without building the full string
+step_repr = StepRepr()
+step_repr.maxstring = 500
+step_repr.maxdict = 20
+step_repr.maxlist = 20
+
+def step_output(observation) -> str:
+    if isinstance(observation, str):
+        return observation[:500]
+    return step_repr.repr(observation)
+
+def message_text(content) -> str:
+    """Extract text from message content - handles both string and list formats."""
+    # Handle different output formats from new LangChain versions
+    if isinstance(content, str):
+        return content
+    if not isinstance(content, list):
+        return str(content)
+    
+    # Extract text from list of message chunks
+    parts = []
+    for item in content:
+        if isinstance(item, dict):
+            if "text" in item:
+                parts.append(item["text"])
+            elif "content" in item:
+                parts.append(str(item["content"]))
+        elif isinstance(item, str):
+            parts.append(item)
+        else:
+            parts.append(str(item))
+    return "".join(parts)
+
+async def stream_agent(memory: ConversationBufferWindowMemory, message: str):
+    """Call the model, execute any requested tools, and repeat until it answers in text.
+
+    Yields {"delta": text} events as tokens arrive, then a final result dict with
+    "output", "agent_steps" and "tools_used".
+    """
+    messages = [
+        system_message,
+        *memory.load_memory_variables({})["chat_history"],
+        HumanMessage(content=message)
+    ]
+    agent_steps = []
+    # Every call in order; deduplicated (order-preserving) when the result is reported
+    tools_used = []
+    
+    for _ in range(max_iterations):
+        ai_message = None
+        async for chunk in app.state.llm_with_tools.astream(messages):
+            ai_message = chunk if ai_message is None else ai_message + chunk
+            delta = message_text(chunk.content)
+            if delta:
+                yield {"delta": delta}
+        
+        if not ai_message.tool_calls:
+            yield {"output": ai_message.content, "agent_steps": agent_steps, "tools_used": list(dict.fromkeys(tools_used))}
+            return
+        
+        messages.append(ai_message)
+        for tool_call in ai_message.tool_calls:
+            selected_tool = tools_by_name.get(tool_call["name"])
+            if selected_tool is None:
+                observation = f"{tool_call['name']} is not a valid tool, try one of [{', '.join(tools_by_name)}]."
+            else:
+                observation = await selected_tool.ainvoke(tool_call["args"])
+            
+            messages.append(ToolMessage(
+                content=observation if isinstance(observation, str) else json.dumps(observation),
+                tool_call_id=tool_call["id"]
+            ))
+            agent_steps.append({
+                "tool": tool_call["name"],
+                "input": str(tool_call["args"]),
+                "output": step_output(observation)
+            })
+            tools_used.append(tool_call["name"])
+    
+    yield {
+        "output": "Agent stopped due to max iterations.",
+        "agent_steps": agent_steps,
+        "tools_used": list(dict.fromkeys(tools_used)),
+        "stopped": True
+    }
+
+async def run_agent(memory: ConversationBufferWindowMemory, message: str) -> dict:
+    """Run the agent to completion and return its final result."""
+    async for event in stream_agent(memory, message):
+        pass
+    return event
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the LLM, embedding model and knowledge base embeddings once per worker at startup."""
+    # One thread per worker avoids CPU oversubscription when uvicorn runs several workers
+    num_threads = 1 if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 else 0
+    
+    app.state.llm = ChatAnthropic(
+        model="claude-sonnet-4-5-20250929",
+        temperature=0,
+        api_key=os.getenv("ANTHROPIC_API_KEY")
+    )
+    # Bind tools once; run_agent dispatches the model's tool calls directly
+    app.state.llm_with_tools = app.state.llm.bind_tools(load_tool_schemas())
+    # Optional embedding model shared by the semantic response cache and knowledge base search
+    app.state.embeddings = load_embeddings(num_threads)
+    app.state.kb_emb, app.state.kb_texts = load_kb_index()
+    yield
+
+# Initialize FastAPI
+app = FastAPI(title="Agentic CX Assistant", default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# CORS middleware
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
 )
 
-# Create agent
-agent = create_tool_calling_agent(llm=llm, tools=tools, prompt=prompt)
+class PreflightMiddleware:
+    """Answer CORS preflight requests from precomputed headers before CORSMiddleware sees them.
+
+    Mirrors CORSMiddleware's allow-all-with-credentials behaviour: the request origin and
+    headers are echoed back, everything else is fixed. max-age lets browsers skip repeat preflights.
+    """
+
+    static_headers = [
+        (b"access-control-allow-methods", b"DELETE, GET, OPTIONS, POST"),
+        (b"access-control-allow-credentials", b"true"),
+        (b"access-control-max-age", b"86400"),
+        (b"vary", b"Origin"),
+    ]
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "OPTIONS":
+            return await self.app(scope, receive, send)
+        
+        headers = dict(scope["headers"])
+        origin = headers.get(b"origin")
+        if origin is None or b"access-control-request-method" not in headers:
+            return await self.app(scope, receive, send)
+        
+        response_headers = [(b"access-control-allow-origin", origin), *self.static_headers]
+        requested_headers = headers.get(b"access-control-request-headers")
+        if requested_headers:
+            response_headers.append((b"access-control-allow-headers", requested_headers))
+        await send({"type": "http.response.start", "status": 204, "headers": response_headers})
+        await send({"type": "http.response.body", "body": b""})
+
+# Added last so it runs first
+app.add_middleware(PreflightMiddleware)
 
 # Request/Response models
 class ChatRequest(BaseModel):
@@ -192,78 +556,81 @@ def status():
         "llm": "claude-sonnet-4-5-20250929"
     }
 
+def get_session_memory(session_id: str) -> ConversationBufferWindowMemory:
+    # Get or create session memory
+    if session_id not in sessions:
+        sessions[session_id] = ConversationBufferWindowMemory(
+            k=6,
+            memory_key="chat_history",
+            return_messages=True
+        )
+    
+    memory = sessions[session_id]
+    # Re-set to restart the idle timer
+    sessions[session_id] = memory
+    return memory
+
+def lock_in_use(lock: asyncio.Lock) -> bool:
+    # A released lock can still have a woken waiter that has not re-acquired it yet
+    return lock.locked() or bool(getattr(lock, "_waiters", None))
+
+def get_session_lock(session_id: str) -> asyncio.Lock:
+    # Drop idle locks of expired sessions once they start to pile up
+    if len(session_locks) > 2 * len(sessions) + 100:
+        for sid in [sid for sid, lock in session_locks.items() if sid not in sessions and not lock_in_use(lock)]:
+            del session_locks[sid]
+    return session_locks[session_id]
+
+async def embed_message(message: str) -> Optional[np.ndarray]:
+    """Embed a chat message for the semantic cache, or None when embeddings are disabled."""
+    if app.state.embeddings is None:
+        return None
+    return np.asarray(
+        await run_in_threadpool(app.state.embeddings.embed_query, message),
+        dtype=np.float32
+    )
+
+def finish_chat(request: ChatRequest, memory: ConversationBufferWindowMemory,
+                query_embedding: Optional[np.ndarray], result: dict) -> ChatResponse:
+    """Build the response from an agent result, then record it in session memory and the cache."""
+    response_text = message_text(result["output"])
+    cacheable = not result.get("stopped") and bool(result["tools_used"]) and set(result["tools_used"]) <= cacheable_tools
+    
+    # Fallback if response is empty
+    if not response_text or response_text.strip() == "":
+        response_text = "I processed your request but encountered an issue formatting the response. Please try again."
+        cacheable = False
+    
+    memory.save_context({"input": request.message}, {"output": response_text})
+    
+    response = ChatResponse(
+        response=response_text,
+        agent_steps=result["agent_steps"],
+        tools_used=result["tools_used"]
+    )
+    
+    if query_embedding is not None and cacheable:
+        response_cache.put(request.session_id, query_embedding, response.model_dump())
+    
+    return response
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     try:
-        # Get or create session memory
-        if request.session_id not in sessions:
-            sessions[request.session_id] = ConversationBufferMemory(
-                memory_key="chat_history",
-                return_messages=True
-            )
-        
-        memory = sessions[request.session_id]
-        
-        # Create executor with memory
-        executor = AgentExecutor(
-            agent=agent,
-            tools=tools,
-            memory=memory,
-            verbose=True,
-            return_intermediate_steps=True,
-            max_iterations=5,
-            handle_parsing_errors=True
-        )
-        
-        # Execute agent
-        result = executor.invoke({"input": request.message})
-        
-        # Extract response text - handle both string and list formats
-        output = result.get("output", "")
-        
-        # Handle different output formats from new LangChain versions
-        response_text = ""
-        if isinstance(output, list):
-            # Extract text from list of message chunks
-            for item in output:
-                if isinstance(item, dict):
-                    if "text" in item:
-                        response_text += item["text"]
-                    elif "content" in item:
-                        response_text += str(item["content"])
-                elif isinstance(item, str):
-                    response_text += item
-                else:
-                    response_text += str(item)
-        elif isinstance(output, str):
-            response_text = output
-        else:
-            response_text = str(output)
-        
-        # Fallback if response is empty
-        if not response_text or response_text.strip() == "":
-            response_text = "I processed your request but encountered an issue formatting the response. Please try again."
-        
-        # Extract agent steps and tools used
-        agent_steps = []
-        tools_used = []
-        
-        if "intermediate_steps" in result:
-            for step in result["intermediate_steps"]:
-                action, output = step
-                agent_steps.append({
-                    "tool": action.tool,
-                    "input": str(action.tool_input),
-                    "output": str(output)
-                })
-                if action.tool not in tools_used:
-                    tools_used.append(action.tool)
-        
-        return ChatResponse(
-            response=response_text,
-            agent_steps=agent_steps,
-            tools_used=tools_used
-        )
+        async with get_session_lock(request.session_id):
+            memory = get_session_memory(request.session_id)
+            
+            # Serve near-duplicate questions from the semantic cache
+            query_embedding = await embed_message(request.message)
+            if query_embedding is not None:
+                cached = response_cache.get(request.session_id, query_embedding)
+                if cached is not None:
+                    memory.save_context({"input": request.message}, {"output": cached["response"]})
+                    return ChatResponse(**cached)
+            
+            # Execute agent without blocking the event loop
+            result = await run_agent(memory, request.message)
+            return finish_chat(request, memory, query_embedding, result)
         
     except Exception as e:
         print(f"Error: {str(e)}")
@@ -271,10 +638,50 @@ async def chat(request: ChatRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+def sse_event(data: dict) -> bytes:
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Server-sent events: {"delta": ...} as tokens arrive, then the full ChatResponse."""
+    async def event_stream():
+        try:
+            async with get_session_lock(request.session_id):
+                memory = get_session_memory(request.session_id)
+                
+                query_embedding = await embed_message(request.message)
+                if query_embedding is not None:
+                    cached = response_cache.get(request.session_id, query_embedding)
+                    if cached is not None:
+                        memory.save_context({"input": request.message}, {"output": cached["response"]})
+                        yield sse_event(cached)
+                        return
+                
+                async for event in stream_agent(memory, request.message):
+                    if "delta" in event:
+                        yield sse_event(event)
+                yield sse_event(finish_chat(request, memory, query_embedding, event).model_dump())
+            
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            yield sse_event({"error": str(e)})
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.delete("/session/{session_id}")
-def clear_session(session_id: str):
-    if session_id in sessions:
-        del sessions[session_id]
+async def clear_session(session_id: str):
+    # Wait for any in-flight turn so it cannot write back into the cleared session
+    lock = get_session_lock(session_id)
+    async with lock:
+        response_cache.clear(session_id)
+        found = sessions.pop(session_id, None) is not None
+    
+    if session_locks.get(session_id) is lock and not lock_in_use(lock):
+        del session_locks[session_id]
+    
+    if found:
         return {"status": "cleared", "session_id": session_id}
     return {"status": "not_found", "session_id": session_id}
 